@@ -0,0 +1,537 @@
+import copy
+import fnmatch
+import itertools
+import time
+import types
+import xml.etree.ElementTree as ET
+
+import pytest
+
+# Rewrites the path so the module can be imported like it normally is
+import os
+import sys
+
+topdir = os.path.join(os.path.dirname(__file__), "..")
+sys.path.append(topdir)
+
+import topology_utils
+
+
+VOSUMMARY = b"""<?xml version="1.0" encoding="UTF-8"?>
+<VOSummary>
+  <VO>
+    <ID>1</ID>
+    <Name>TestVO</Name>
+    <LongName>Test VO</LongName>
+    <ReportingGroups>
+      <ReportingGroup>
+        <Name>ReportingGroupName</Name>
+        <Contacts>
+          <Contact><Name>Reporting Contact</Name></Contact>
+        </Contacts>
+      </ReportingGroup>
+    </ReportingGroups>
+    <ContactTypes>
+      <ContactType>
+        <Type>Miscellaneous Contact</Type>
+        <Contacts>
+          <Contact>
+            <Name>Jane Doe</Name>
+            <Email>jane@example.com</Email>
+            <CILogonID>http://cilogon.org/serverA/users/1</CILogonID>
+          </Contact>
+          <Contact>
+            <Name>John Doe &amp; Co</Name>
+            <Email></Email>
+          </Contact>
+        </Contacts>
+      </ContactType>
+      <ContactType>
+        <Type>Security Contact</Type>
+        <Contacts>
+          <Contact><Name>Sec Person</Name><Email>sec@example.com</Email></Contact>
+        </Contacts>
+      </ContactType>
+    </ContactTypes>
+    <Name>NotTheVOName</Name>
+  </VO>
+  <VO>
+    <ID>2</ID>
+    <Name>NoContactsVO</Name>
+    <ContactTypes/>
+  </VO>
+</VOSummary>
+"""
+
+RGSUMMARY = b"""<?xml version="1.0" encoding="UTF-8"?>
+<ResourceSummary>
+  <ResourceGroup>
+    <GroupName>TestRG</GroupName>
+    <Facility><ID>1</ID><Name>Test Facility</Name></Facility>
+    <Site><ID>1</ID><Name>Test Site</Name></Site>
+    <Resources>
+      <Resource>
+        <ID>10</ID>
+        <Name>TEST_CE</Name>
+        <FQDN>ce.example.com</FQDN>
+        <FQDN>ce-alias.example.com</FQDN>
+        <Services>
+          <Service><ID>1</ID><Name>CE</Name></Service>
+        </Services>
+        <ContactLists>
+          <ContactList>
+            <ContactType>Administrative Contact</ContactType>
+            <Contacts>
+              <Contact>
+                <Name>Admin Primary</Name>
+                <Email>admin@example.com</Email>
+                <ContactRank>Primary</ContactRank>
+              </Contact>
+              <Contact>
+                <Name>Admin Secondary</Name>
+                <Email>admin2@example.com</Email>
+                <ContactRank>Secondary</ContactRank>
+              </Contact>
+            </Contacts>
+          </ContactList>
+          <ContactList>
+            <ContactType>Site Contact</ContactType>
+            <Contacts>
+              <Contact><Name>Site Person</Name><ContactRank/></Contact>
+            </Contacts>
+          </ContactList>
+        </ContactLists>
+      </Resource>
+      <Resource>
+        <ID>11</ID>
+        <Name>TEST_NO_CONTACTS</Name>
+        <FQDN>none.example.com</FQDN>
+      </Resource>
+    </Resources>
+  </ResourceGroup>
+</ResourceSummary>
+"""
+
+
+def parse_contacts(document, roottype, chunk_size=None):
+    """Feed `document` to a ContactTarget, optionally in small chunks"""
+    target = topology_utils.ContactTarget(topology_utils.CONTACT_OWNER_PATHS[roottype])
+    parser = ET.XMLParser(target=target)
+    chunk_size = chunk_size or len(document)
+    for i in range(0, len(document), chunk_size):
+        parser.feed(document[i:i + chunk_size])
+    return target, parser.close()
+
+
+def walk_vo_contacts(document):
+    """Reference extraction of VO contacts by walking an element tree"""
+    results = {}
+    for vo in ET.fromstring(document).iterfind('VO'):
+        contacts = []
+        for contact_type in vo.iterfind('ContactTypes/ContactType'):
+            contacts.extend(topology_utils.get_contact_list_info(contact_type))
+        if vo.findtext('Name') and contacts:
+            results[vo.findtext('Name')] = contacts
+    return results
+
+
+def walk_resource_contacts(document):
+    """Reference extraction of resource contacts by walking an element tree"""
+    results_by_name, results_by_fqdn = {}, {}
+    for resource in ET.fromstring(document).iterfind('ResourceGroup/Resources/Resource'):
+        contacts = []
+        for contact_list in resource.iterfind('ContactLists/ContactList'):
+            contacts.extend(topology_utils.get_contact_list_info(contact_list))
+        if contacts:
+            if resource.findtext('Name'):
+                results_by_name[resource.findtext('Name')] = contacts
+            if resource.findtext('FQDN'):
+                results_by_fqdn[resource.findtext('FQDN')] = contacts
+    return results_by_name, results_by_fqdn
+
+
+class FakeResponse:
+    """
+    Just enough of a streamed requests.Response for get_contacts() and
+    get_vo_map(); `chunk_size`, if given, overrides the size asked for
+    """
+    status_code = 200
+
+    def __init__(self, content, chunk_size=None):
+        self.content = content
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        chunk_size = self.chunk_size or chunk_size
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Make get_contacts() receive the given document as its response"""
+    def _serve(document):
+        class FakeSession:
+            def get(self, url, **kwargs):
+                return FakeResponse(document)
+        monkeypatch.setattr(topology_utils, "get_auth_session", lambda args: FakeSession())
+    return _serve
+
+
+@pytest.fixture
+def args():
+    class Args:
+        host = "topology.opensciencegrid.org"
+        provides_service = None
+        owner_vo = None
+    return Args()
+
+
+class TestContactTarget:
+
+    def test_vo_contacts(self):
+        _, (results_by_name, results_by_fqdn) = parse_contacts(VOSUMMARY, 'VO')
+        assert results_by_name == {
+            'TestVO': [
+                {'ContactType': 'miscellaneous contact', 'Name': 'Jane Doe',
+                 'Email': 'jane@example.com',
+                 'CILogonID': 'http://cilogon.org/serverA/users/1'},
+                {'ContactType': 'miscellaneous contact', 'Name': 'John Doe & Co',
+                 'Email': None},
+                {'ContactType': 'security contact', 'Name': 'Sec Person',
+                 'Email': 'sec@example.com'},
+            ]
+        }
+        assert results_by_fqdn == {}
+
+    def test_resource_contacts(self):
+        _, (results_by_name, results_by_fqdn) = parse_contacts(RGSUMMARY, 'Resource')
+        assert list(results_by_name) == ['TEST_CE']
+        assert list(results_by_fqdn) == ['ce.example.com']
+        assert results_by_name['TEST_CE'] == [
+            {'ContactType': 'administrative contact', 'Name': 'Admin Primary',
+             'Email': 'admin@example.com', 'ContactRank': 'Primary'},
+            {'ContactType': 'administrative contact', 'Name': 'Admin Secondary',
+             'Email': 'admin2@example.com', 'ContactRank': 'Secondary'},
+            {'ContactType': 'site contact', 'Name': 'Site Person', 'ContactRank': None},
+        ]
+
+    def test_first_name_and_fqdn_win(self):
+        _, (vo_results, _) = parse_contacts(VOSUMMARY, 'VO')
+        assert 'NotTheVOName' not in vo_results
+        _, (_, results_by_fqdn) = parse_contacts(RGSUMMARY, 'Resource')
+        assert 'ce-alias.example.com' not in results_by_fqdn
+
+    def test_empty_fields_are_none(self):
+        _, (results_by_name, _) = parse_contacts(RGSUMMARY, 'Resource')
+        assert results_by_name['TEST_CE'][2]['ContactRank'] is None
+        _, (vo_results, _) = parse_contacts(VOSUMMARY, 'VO')
+        assert vo_results['TestVO'][1]['Email'] is None
+
+    def test_contacts_outside_contact_lists_ignored(self):
+        _, (vo_results, _) = parse_contacts(VOSUMMARY, 'VO')
+        names = [contact['Name'] for contact in vo_results['TestVO']]
+        assert 'Reporting Contact' not in names
+        assert 'ReportingGroupName' not in vo_results
+
+    @pytest.mark.parametrize("chunk_size", [1, 7, 64])
+    def test_matches_element_walk(self, chunk_size):
+        _, (vo_results, _) = parse_contacts(VOSUMMARY, 'VO', chunk_size)
+        assert vo_results == walk_vo_contacts(VOSUMMARY)
+        _, resource_results = parse_contacts(RGSUMMARY, 'Resource', chunk_size)
+        assert resource_results == walk_resource_contacts(RGSUMMARY)
+
+    def test_root_and_unexpected_tags(self):
+        target, _ = parse_contacts(VOSUMMARY, 'VO')
+        assert target.root_tag == 'VOSummary'
+        assert target.unexpected_tag is None
+
+        target, _ = parse_contacts(b"<VOSummary><Bogus/><VO/></VOSummary>", 'VO')
+        assert target.unexpected_tag == 'Bogus'
+
+        target, _ = parse_contacts(
+            b"<ResourceSummary><ResourceGroup/><Bogus><Resources/></Bogus></ResourceSummary>",
+            'Resource')
+        assert target.unexpected_tag == 'Bogus'
+
+
+class TestGetContacts:
+
+    def test_vo_contacts(self, serve, args):
+        serve(VOSUMMARY)
+        assert topology_utils.get_vo_contacts(args) == walk_vo_contacts(VOSUMMARY)
+
+    def test_resource_contacts(self, serve, args):
+        serve(RGSUMMARY)
+        assert topology_utils.get_resource_contacts_by_name_and_fqdn(args) == \
+            walk_resource_contacts(RGSUMMARY)
+
+    def test_wrong_root(self, serve, args, capsys):
+        serve(RGSUMMARY)
+        assert topology_utils.get_vo_contacts(args) == 1
+        assert "invalid XML with root tag ResourceSummary" in capsys.readouterr().err
+
+        serve(VOSUMMARY)
+        assert topology_utils.get_resource_contacts_by_name_and_fqdn(args) == ({}, {})
+        assert "invalid XML with root tag VOSummary" in capsys.readouterr().err
+
+    def test_unexpected_top_level_element(self, serve, args, capsys):
+        serve(b"<VOSummary><VO><Name>A</Name></VO><Bogus/></VOSummary>")
+        assert topology_utils.get_vo_contacts(args) == 1
+        assert "non-VO (Bogus)" in capsys.readouterr().err
+
+        serve(b"<ResourceSummary><Bogus/></ResourceSummary>")
+        assert topology_utils.get_resource_contacts_by_name_and_fqdn(args) == ({}, {})
+        assert "non-ResourceGroup (Bogus)" in capsys.readouterr().err
+
+
+@pytest.fixture
+def vo_map_cache(monkeypatch):
+    """An empty VO map cache for the test, seeded as needed"""
+    cache = {}
+    monkeypatch.setattr(topology_utils, "_VO_MAP_CACHE", cache)
+    return cache
+
+
+class TestMangleUrl:
+    BASE_URL = "https://topology.opensciencegrid.org/rgsummary/xml?active=on&active_value=1"
+
+    def test_no_selectors_returns_url_unchanged(self, args):
+        assert topology_utils.mangle_url(self.BASE_URL, args) == self.BASE_URL
+        args.host = None
+        assert topology_utils.mangle_url(self.BASE_URL, args) is self.BASE_URL
+
+    def test_no_selectors_changes_host(self, args):
+        args.host = "topology-itb.opensciencegrid.org"
+        assert topology_utils.mangle_url(self.BASE_URL, args) == \
+            "https://topology-itb.opensciencegrid.org/rgsummary/xml?active=on&active_value=1"
+
+    def test_provides_service(self, args):
+        args.provides_service = "CE, xrootd"
+        assert topology_utils.mangle_url(self.BASE_URL, args) == \
+            self.BASE_URL + "&service=on&service_sel%5B%5D=1&service_sel%5B%5D=142"
+
+    def test_service_on_not_added_twice(self, args):
+        args.provides_service = "gridftp"
+        url = self.BASE_URL + "&service=on"
+        assert topology_utils.mangle_url(url, args) == url + "&service_sel%5B%5D=5"
+
+    def test_unknown_service(self, args):
+        args.provides_service = "ce,bogus"
+        with pytest.raises(Exception, match="Requested service bogus not known"):
+            topology_utils.mangle_url(self.BASE_URL, args)
+
+    def test_owner_vo(self, args, vo_map_cache):
+        vo_map_cache[args.host] = (time.monotonic(), {"testvo": "7", "othervo": "12"})
+        args.owner_vo = "TestVO,othervo"
+        assert topology_utils.mangle_url(self.BASE_URL, args) == \
+            self.BASE_URL + "&voown=on&voown_sel%5B%5D=7&voown_sel%5B%5D=12"
+
+    def test_unknown_owner_vo(self, args, vo_map_cache):
+        vo_map_cache[args.host] = (time.monotonic(), {"testvo": "7"})
+        args.owner_vo = "bogusvo"
+        with pytest.raises(Exception, match="Requested owner VO bogusvo not known"):
+            topology_utils.mangle_url(self.BASE_URL, args)
+
+    def test_selectors_without_host(self, args, vo_map_cache):
+        args.host = None
+        vo_map_cache["topology.opensciencegrid.org"] = (time.monotonic(), {"testvo": "7"})
+        args.provides_service = "ce"
+        args.owner_vo = "testvo"
+        assert topology_utils.mangle_url(self.BASE_URL, args) == \
+            self.BASE_URL + "&service=on&service_sel%5B%5D=1&voown=on&voown_sel%5B%5D=7"
+
+
+def reference_filter_contacts(args, results):
+    """filter_contacts() as it was before the single-pass rewrite"""
+    results = dict(results)
+
+    if getattr(args, 'name_filter', None):
+        for name in list(results):
+            if not fnmatch.fnmatch(name, args.name_filter) and \
+                    args.name_filter not in name:
+                del results[name]
+    elif getattr(args, 'fqdn_filter', None):
+        for fqdn in list(results):
+            if not fnmatch.fnmatch(fqdn, args.fqdn_filter) and \
+                    args.fqdn_filter not in fqdn:
+                del results[fqdn]
+
+    if 'all' not in args.contact_type:
+        for name in list(results):
+            contact_list = []
+            for contact in results[name]:
+                contact_type = contact['ContactType']
+                for args_contact_type in args.contact_type:
+                    if contact_type.startswith(args_contact_type):
+                        contact_list.append(contact)
+            if contact_list == []:
+                del results[name]
+            else:
+                results[name] = contact_list
+
+    if getattr(args, 'contact_emails', None):
+        for name in list(results):
+            contact_list = [contact for contact in results[name] if contact['Email'] in args.contact_emails]
+            if not contact_list:
+                del results[name]
+            else:
+                results[name] = contact_list
+
+    return results
+
+
+def make_contact(contact_type, email):
+    return {'ContactType': contact_type, 'Name': email.split('@')[0], 'Email': email}
+
+
+CONTACTS = {
+    'TEST_CE': [make_contact('administrative contact', 'admin@example.com'),
+                make_contact('security contact', 'sec@example.com'),
+                make_contact('local security contact', 'localsec@example.com')],
+    'TEST_SE': [make_contact('site contact', 'site@example.com'),
+                make_contact('administrative contact', 'admin@example.com')],
+    'ce.example.org': [make_contact('miscellaneous contact', 'misc@example.org')],
+}
+
+
+def filter_args(name_filter=None, fqdn_filter=None, contact_type=('all',),
+                contact_emails=None):
+    return types.SimpleNamespace(name_filter=name_filter, fqdn_filter=fqdn_filter,
+                                 contact_type=list(contact_type),
+                                 contact_emails=contact_emails)
+
+
+class TestFilterContacts:
+
+    def test_no_filter_returns_input(self):
+        results = dict(CONTACTS)
+        assert topology_utils.filter_contacts(filter_args(), results) is results
+
+    def test_no_filter_copy(self):
+        results = dict(CONTACTS)
+        filtered = topology_utils.filter_contacts(filter_args(), results, copy=True)
+        assert filtered is not results
+        assert filtered == results
+
+    @pytest.mark.parametrize("args", [
+        filter_args(name_filter="TEST_C*"),
+        filter_args(contact_type=["administrative"]),
+        filter_args(contact_emails=["admin@example.com"]),
+        filter_args(name_filter="TEST", contact_type=["security"],
+                    contact_emails=["sec@example.com"]),
+    ])
+    def test_input_not_modified(self, args):
+        results = copy.deepcopy(CONTACTS)
+        topology_utils.filter_contacts(args, results)
+        assert results == CONTACTS
+
+    def test_repeated_contact_type_not_duplicated(self):
+        filtered = topology_utils.filter_contacts(
+            filter_args(contact_type=["administrative", "administrative"]), CONTACTS)
+        assert filtered == {
+            'TEST_CE': [CONTACTS['TEST_CE'][0]],
+            'TEST_SE': [CONTACTS['TEST_SE'][1]],
+        }
+
+    @pytest.mark.parametrize("name_filter, fqdn_filter, contact_type, contact_emails",
+        list(itertools.product(
+            [None, "TEST_*", "SE", "nomatch"],
+            [None, "*.example.org"],
+            [["all"], ["administrative"], ["site", "security"], ["local"]],
+            [None, ["admin@example.com", "sec@example.com"], ["nobody@example.com"]],
+        )))
+    def test_matches_reference(self, name_filter, fqdn_filter, contact_type,
+                               contact_emails):
+        args = filter_args(name_filter, fqdn_filter, contact_type, contact_emails)
+        assert topology_utils.filter_contacts(args, CONTACTS) == \
+            reference_filter_contacts(args, CONTACTS)
+
+
+VO_MAP_SUMMARY = b"""<?xml version="1.0" encoding="UTF-8"?>
+<VOSummary>
+  <VO><ID>1</ID><Name>TestVO</Name><LongName>Test VO</LongName></VO>
+  <VO><Name>NoIDVO</Name></VO>
+  <VO><ID>3</ID><Name>OtherVO</Name><ReportingGroups><ReportingGroup><Name>RG</Name></ReportingGroup></ReportingGroups></VO>
+</VOSummary>
+"""
+
+
+class CountingSession:
+    """A session serving `document`, counting the requests made to it"""
+    def __init__(self, document, chunk_size=None):
+        self.document = document
+        self.chunk_size = chunk_size
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return FakeResponse(self.document, self.chunk_size)
+
+
+class TestIterparseSummary:
+
+    @pytest.mark.parametrize("chunk_size", [1, 5, 64])
+    def test_children(self, chunk_size):
+        root, children = topology_utils.iterparse_summary(
+            FakeResponse(VO_MAP_SUMMARY, chunk_size))
+        assert root.tag == 'VOSummary'
+        seen = []
+        for child in children:
+            # children already handed out have been cleared from the root
+            assert not any(earlier is element for earlier in seen for element in root)
+            seen.append(child)
+        assert [(vo.findtext('Name'), vo.findtext('ID')) for vo in seen] == \
+            [('TestVO', '1'), ('NoIDVO', None), ('OtherVO', '3')]
+        assert seen[2].findtext('ReportingGroups/ReportingGroup/Name') == 'RG'
+
+    def test_response_closed(self):
+        response = FakeResponse(VO_MAP_SUMMARY, 16)
+        _, children = topology_utils.iterparse_summary(response)
+        list(children)
+        assert response.closed
+
+
+class TestGetVoMap:
+
+    @pytest.mark.parametrize("chunk_size", [1, 7, None])
+    def test_vo_map(self, args, vo_map_cache, chunk_size):
+        session = CountingSession(VO_MAP_SUMMARY, chunk_size)
+        assert topology_utils.get_vo_map(args, session) == {'testvo': '1', 'othervo': '3'}
+
+    def test_cached_within_ttl(self, args, vo_map_cache):
+        session = CountingSession(VO_MAP_SUMMARY, 7)
+        vo_map = topology_utils.get_vo_map(args, session)
+        assert topology_utils.get_vo_map(args, session) is vo_map
+        assert len(session.urls) == 1
+
+    def test_refetched_after_ttl(self, args, vo_map_cache, monkeypatch):
+        session = CountingSession(VO_MAP_SUMMARY, 7)
+        topology_utils.get_vo_map(args, session)
+        monkeypatch.setattr(topology_utils, "VO_MAP_TTL", 0)
+        topology_utils.get_vo_map(args, session)
+        assert len(session.urls) == 2
+
+    def test_cached_per_host(self, args, vo_map_cache):
+        session = CountingSession(VO_MAP_SUMMARY, 7)
+        topology_utils.get_vo_map(args, session)
+        args.host = "topology-itb.opensciencegrid.org"
+        topology_utils.get_vo_map(args, session)
+        assert [url.split('/')[2] for url in session.urls] == \
+            ["topology.opensciencegrid.org", "topology-itb.opensciencegrid.org"]
+
+    def test_wrong_root(self, args, vo_map_cache):
+        session = CountingSession(RGSUMMARY, 7)
+        with pytest.raises(Exception, match="invalid XML with root tag ResourceSummary"):
+            topology_utils.get_vo_map(args, session)
+        assert vo_map_cache == {}
@@ -4,14 +4,19 @@ service.
 """
 
 import os
+import re
 import sys
+import time
 import urllib
+import threading
 import fnmatch
 import urllib.parse as urlparse
 
 import xml.etree.ElementTree as ET
 
-import requests
+# requests, ssl and concurrent.futures are only imported by the functions
+# that query topology, so that using the XML and filtering helpers (or just
+# running --help) does not pay for importing them.
 
 # List of contact types stored in Topology data
 # At time of writing, there isn't anything that restricts a contact to one of these types
@@ -36,10 +41,70 @@ class InvalidPathError(AuthError):
 class IncorrectPasswordError(AuthError):
     pass
 
+def get_ssl_context_adapter(ssl_context, **kwargs):
+    """
+    Return an HTTPAdapter whose connections all share `ssl_context`.
+
+    The context carries the client certificate, so the key is loaded (and
+    its passphrase asked for) once rather than for every new connection;
+    the adapter's pools keep connections alive for reuse across queries.
+    Remaining keyword arguments are passed on to HTTPAdapter.
+    """
+    import requests.adapters
+
+    class SSLContextAdapter(requests.adapters.HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs['ssl_context'] = ssl_context
+            return super().init_poolmanager(*args, **kwargs)
+
+        def proxy_manager_for(self, *args, **kwargs):
+            kwargs['ssl_context'] = ssl_context
+            return super().proxy_manager_for(*args, **kwargs)
+
+    return SSLContextAdapter(**kwargs)
+
+
+# Hosts that are always contacted directly, bypassing any proxy from the
+# environment.  This is passed with each request instead of being set in
+# os.environ around it.
+NO_PROXY = '.opensciencegrid.org'
+
+def get_ssl_context(cert, key):
+    """
+    Return an SSLContext with the given client cert and key loaded.
+    """
+    import ssl
+
+    # No CAs are loaded here: requests adds the bundle it is configured with
+    # (certifi or REQUESTS_CA_BUNDLE), which stays the only trust source.
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    try:
+        context.load_cert_chain(cert, key)
+    except OSError as exc:
+        if exc.errno == 22:
+            raise IncorrectPasswordError("Incorrect password, please try again")
+        raise AuthError("Error: could not load cert %s and key %s: %s"
+                        % (cert, key, exc))
+
+    return context
+
+
+# Sessions shared by every query made by this process, keyed on the
+# (cert, key) pair used to authenticate, so that connections to topology
+# are kept alive and reused instead of being re-established for each query,
+# and the key is loaded (and its passphrase asked for) only once.
+_SESSIONS = {}
+
+# Serializes session setup so concurrent queries (see fetch_all()) load the
+# key, and prompt for its passphrase, only once.
+_AUTH_LOCK = threading.Lock()
+
 def get_auth_session(args):
     """
     Return a requests session ready for an XML query.
     """
+    import requests
+
     euid = os.geteuid()
     if euid == 0:
         cert = '/etc/grid-security/hostcert.pem'
@@ -56,18 +121,20 @@ def get_auth_session(args):
     if args.key:
         key = args.key
 
-    session = requests.Session()
-
-    if os.path.exists(cert):
-        session.cert = cert
-    else:
+    if not os.path.exists(cert):
         raise InvalidPathError("Error: could not find cert at %s" % cert)
-    
-    if os.path.exists(key):
-        session.cert = (cert, key)
-    else:
+    if not os.path.exists(key):
         raise InvalidPathError("Error: could not find key at %s" % key)
 
+    with _AUTH_LOCK:
+        session = _SESSIONS.get((cert, key))
+        if session is None:
+            session = requests.Session()
+            adapter = get_ssl_context_adapter(get_ssl_context(cert, key),
+                                              pool_connections=4, pool_maxsize=16)
+            session.mount('https://', adapter)
+            _SESSIONS[(cert, key)] = session
+
     return session
 
 
@@ -128,59 +195,95 @@ def get_contact_list_info(contact_list):
       ...
     }
     """
+    contact_list_type = (contact_list.findtext('ContactType') or
+                         contact_list.findtext('Type')).lower()
     contact_list_info = []
-    for contact in contact_list:
-        if contact.tag == 'ContactType' or contact.tag == 'Type':
-            contact_list_type = contact.text.lower()
-        if contact.tag == 'Contacts':
-            for con in contact:
-                contact_info = { 'ContactType' : contact_list_type }
-                for contact_contents in con:
-                    contact_info[contact_contents.tag] = contact_contents.text
-                contact_list_info.append(contact_info)
+    for con in contact_list.iterfind('Contacts/Contact'):
+        contact_info = {child.tag: child.text for child in con}
+        contact_info['ContactType'] = contact_list_type
+        contact_list_info.append(contact_info)
 
     return contact_list_info
 
 
+def iterparse_summary(response):
+    """
+    Incrementally parse a streamed MyOSG summary response.
+
+    Returns a tuple of the root element and an iterator over the root's
+    direct children.  The body is fed to the parser chunk by chunk as it
+    arrives, and each child is dropped from the tree as soon as the caller
+    moves on to the next one, so only one top-level element (e.g. a single
+    <VO> or <ResourceGroup>) is held in memory at a time.
+    """
+    parser = ET.XMLPullParser(events=('start', 'end'))
+
+    def read_events():
+        with response:
+            for chunk in response.iter_content(32768):
+                parser.feed(chunk)
+                yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    events = read_events()
+    _, root = next(events)
+
+    def children():
+        depth = 0
+        for event, elem in events:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 0:
+                yield elem
+                root.clear()
+
+    return root, children()
+
+
+# The VO list changes rarely; cache each host's VO map for this many seconds
+VO_MAP_TTL = 600
+
+# Host -> (time fetched, VO map)
+_VO_MAP_CACHE = {}
+
 def get_vo_map(args, session=None):
     """
     Generate a dictionary mapping from the VO name (key) to the
     VO ID (value).
+
+    The map is cached per host for VO_MAP_TTL seconds.
     """
-    old_no_proxy = os.environ.pop('no_proxy', None)
-    os.environ['no_proxy'] = '.opensciencegrid.org'
+    import requests
+
+    host = args.host or 'topology.opensciencegrid.org'
+    cached = _VO_MAP_CACHE.get(host)
+    if cached and time.monotonic() - cached[0] < VO_MAP_TTL:
+        return cached[1]
 
-    url = update_url_hostname("https://topology.opensciencegrid.org/vosummary"
-                              "/xml?all_vos=on&active_value=1", args)
     if session is None:
-        with get_auth_session(args) as session:
-            response = session.get(url)
-    else:
-        response = session.get(url)
+        session = get_auth_session(args)
 
-    if old_no_proxy is not None:
-        os.environ['no_proxy'] = old_no_proxy
-    else:
-        del os.environ['no_proxy']
+    url = update_url_hostname("https://topology.opensciencegrid.org/vosummary"
+                              "/xml?all_vos=on&active_value=1", args)
+    response = session.get(url, stream=True,
+                           proxies={'no_proxy': NO_PROXY})
 
     if response.status_code != requests.codes.ok:
         raise Exception("MyOSG request failed (status %d): %s" % \
               (response.status_code, response.text[:2048]))
 
-    root = ET.fromstring(response.content)
+    root, children = iterparse_summary(response)
     if root.tag != 'VOSummary':
+        response.close()
         raise Exception("MyOSG returned invalid XML with root tag %s" % root.tag)
-    vo_map = {}
-    for child_vo in root:
-        if child_vo.tag != "VO":
-            raise Exception("MyOSG returned a non-VO  (%s) inside VO summary." % \
-                            root.tag)
-        vo_info = {}
-        for child_info in child_vo:
-            vo_info[child_info.tag] = child_info.text
-        if 'ID' in vo_info and 'Name' in vo_info:
-            vo_map[vo_info['Name'].lower()] = vo_info['ID']
+    vo_info = ((child_vo.findtext('Name'), child_vo.findtext('ID'))
+               for child_vo in children if child_vo.tag == 'VO')
+    vo_map = {name.lower(): vo_id for name, vo_id in vo_info if name and vo_id}
 
+    _VO_MAP_CACHE[host] = (time.monotonic(), vo_map)
     return vo_map
 
 
@@ -192,116 +295,245 @@ SERVICE_IDS = {'ce': 1,
                'perfsonar-latency': 130,
                'gums': 101,
               }
+# Pre-encoded "service_sel[]=<id>" query string parameters for each service
+SERVICE_SEL_QUERY = {service: urlparse.urlencode({"service_sel[]": service_id})
+                     for service, service_id in SERVICE_IDS.items()}
+VOOWN_SEL_PREFIX = urlparse.quote_plus("voown_sel[]") + "="
+
 def mangle_url(url, args, session=None):
     """
     Given a MyOSG URL, switch to using the hostname specified in the
     arguments
     """
-    if not args.host:
-        return url
+    provides_service = getattr(args, 'provides_service', None)
+    owner_vo = getattr(args, 'owner_vo', None)
+    if not provides_service and not owner_vo:
+        # Nothing to add to the query string
+        return update_url_hostname(url, args)
+
     url_list = list(urlparse.urlsplit(url))
-    url_list[1] = args.host
+    if args.host:
+        url_list[1] = args.host
 
-    qs_dict = urlparse.parse_qs(url_list[3])
-    qs_list = urlparse.parse_qsl(url_list[3])
+    qs_keys = {key for key, _ in urlparse.parse_qsl(url_list[3])}
+    # Parameters appended, already encoded, to the existing query string
+    query = [url_list[3]] if url_list[3] else []
 
-    if getattr(args, 'provides_service', None):
-        if 'service' not in qs_dict:
-            qs_list.append(("service", "on"))
-        for service in args.provides_service.split(","):
+    if provides_service:
+        if 'service' not in qs_keys:
+            query.append("service=on")
+        for service in provides_service.split(","):
             service = service.strip().lower()
-            service_id = SERVICE_IDS.get(service)
-            if not service_id:
+            service_query = SERVICE_SEL_QUERY.get(service)
+            if not service_query:
                 raise Exception("Requested service %s not known; known service"
                                 " names: %s" % (service, ", ".join(SERVICE_IDS)))
-            qs_list.append(("service_sel[]", str(service_id)))
+            query.append(service_query)
 
-    if getattr(args, 'owner_vo', None):
+    if owner_vo:
         vo_map = get_vo_map(args, session)
-        if 'voown' not in qs_dict:
-            qs_list.append(("voown", "on"))
-        for vo in args.owner_vo.split(","):
+        if 'voown' not in qs_keys:
+            query.append("voown=on")
+        for vo in owner_vo.split(","):
             vo = vo.strip().lower()
             vo_id = vo_map.get(vo)
             if not vo_id:
                 raise Exception("Requested owner VO %s not known; known VOs: %s" \
                     % (vo, ", ".join(vo_map)))
-            qs_list.append(("voown_sel[]", str(vo_id)))
+            query.append(VOOWN_SEL_PREFIX + urlparse.quote_plus(vo_id))
 
-    url_list[3] = urlparse.urlencode(qs_list, doseq=True)
+    url_list[3] = "&".join(query)
 
     return urlparse.urlunsplit(url_list)
 
 
+# Tags looked for by ContactTarget, relative to a contact owner element:
+# the owner's own text fields,
+_OWNER_TEXT_TAGS = frozenset(('Name', 'FQDN'))
+# contact list elements (vosummary, rgsummary) and their containers,
+_CONTACT_LIST_PARENTS = {'ContactType': 'ContactTypes',
+                         'ContactList': 'ContactLists'}
+# and the element naming a contact list's type (vosummary, rgsummary).
+_LIST_TYPE_TAGS = frozenset(('Type', 'ContactType'))
+
+class ContactTarget:
+    """
+    XMLParser target that extracts contacts from a vosummary or rgsummary
+    document while it is being parsed, without building an element tree.
+
+    `owner_path` is the path of tags below the root down to the elements
+    that own the contact lists: ('VO',) in vosummary or
+    ('ResourceGroup', 'Resources', 'Resource') in rgsummary.  Each owner's
+    contacts are collected as get_contact_list_info() would return them,
+    and close() returns two dicts of them, one keyed on the owners' <Name>
+    and one keyed on their <FQDN>.
+
+    After parsing, `root_tag` holds the tag of the document root and
+    `unexpected_tag` the first top-level element that is not an owner_path[0]
+    (or None).
+    """
+    def __init__(self, owner_path):
+        self.owner_path = list(owner_path)
+        self.root_tag = None
+        self.unexpected_tag = None
+        self._owner_depth = len(owner_path)
+        self._stack = []
+        self._text = None
+        self._in_owner = False
+        self._in_list = False
+        self._name = None
+        self._fqdn = None
+        self._contacts = None
+        self._list_type = None
+        self._contact = None
+        self._results_by_name = {}
+        self._results_by_fqdn = {}
+
+    def start(self, tag, attrib):
+        if self.root_tag is None:
+            self.root_tag = tag
+            return
+        stack = self._stack
+        stack.append(tag)
+        self._text = None
+        depth = len(stack) - self._owner_depth
+
+        if len(stack) == 1 and tag != self.owner_path[0] and \
+                self.unexpected_tag is None:
+            self.unexpected_tag = tag
+
+        if depth < 0:
+            pass
+        elif depth == 0:
+            self._in_owner = stack == self.owner_path
+            self._name = self._fqdn = None
+            self._contacts = []
+        elif not self._in_owner:
+            pass
+        elif depth == 1:
+            # <Name>, <FQDN>
+            if tag in _OWNER_TEXT_TAGS:
+                self._text = []
+        elif depth == 2:
+            # <ContactTypes><ContactType> or <ContactLists><ContactList>
+            self._in_list = _CONTACT_LIST_PARENTS.get(tag) == stack[-2]
+            self._list_type = None
+        elif depth == 3:
+            # <Type> or <ContactType>
+            if self._in_list and tag in _LIST_TYPE_TAGS:
+                self._text = []
+        elif depth == 4:
+            # <Contacts><Contact>
+            if self._in_list and tag == 'Contact' and stack[-2] == 'Contacts':
+                self._contact = { 'ContactType' : self._list_type }
+        elif depth == 5:
+            # <Name>, <Email>, etc. of a contact
+            if self._contact is not None:
+                self._text = []
+
+    def end(self, tag):
+        stack = self._stack
+        if not stack:
+            return
+        depth = len(stack) - self._owner_depth
+        stack.pop()
+        if depth < 0 or not self._in_owner:
+            return
+        if self._text is not None:
+            text = ''.join(self._text) or None
+            self._text = None
+        else:
+            text = None
+
+        if depth == 0:
+            if self._contacts:
+                if self._name:
+                    self._results_by_name[self._name] = self._contacts
+                if self._fqdn:
+                    self._results_by_fqdn[self._fqdn] = self._contacts
+            self._in_owner = False
+        elif depth == 1:
+            if tag == 'Name' and self._name is None:
+                self._name = text
+            elif tag == 'FQDN' and self._fqdn is None:
+                self._fqdn = text
+        elif depth == 2:
+            self._in_list = False
+        elif depth == 3:
+            if self._in_list and tag in _LIST_TYPE_TAGS:
+                self._list_type = (text or '').lower()
+        elif depth == 4:
+            if self._contact is not None:
+                self._contacts.append(self._contact)
+                self._contact = None
+        elif depth == 5:
+            if self._contact is not None:
+                self._contact[tag] = text
+
+    def data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+    def close(self):
+        return self._results_by_name, self._results_by_fqdn
+
+
+# Path from below the summary root to the elements owning contact lists,
+# keyed on the summary type
+CONTACT_OWNER_PATHS = {'VO': ('VO',),
+                       'Resource': ('ResourceGroup', 'Resources', 'Resource'),
+                      }
+
 def get_contacts(args, urltype, roottype):
     """
     Get one type of contacts for OSG.
+
+    The response is parsed with a ContactTarget as it is downloaded.
+    Returns a tuple of the contacts keyed on name and keyed on FQDN, or
+    None if the request failed.
     """
-    old_no_proxy = os.environ.pop('no_proxy', None)
-    os.environ['no_proxy'] = '.opensciencegrid.org'
+    import requests
 
     base_url = "https://topology.opensciencegrid.org/" + urltype + "summary/xml?" \
-               "&active=on&active_value=1&disable=on&disable_value=0"
-    with get_auth_session(args) as session:
-        url = mangle_url(base_url, args, session)
-        try:
-            response = session.get(url)
-        except requests.exceptions.ConnectionError as exc:
-            try:
-                if exc.args[0].args[1].errno == 22:
-                    raise IncorrectPasswordError("Incorrect password, please try again")
-                else:
-                    raise exc
-            except (TypeError, AttributeError, IndexError):
-                raise exc
-
-    if old_no_proxy is not None:
-        os.environ['no_proxy'] = old_no_proxy
-    else:
-        del os.environ['no_proxy']
+               "active=on&active_value=1&disable=on&disable_value=0"
+    session = get_auth_session(args)
+    url = mangle_url(base_url, args, session)
+    response = session.get(url, stream=True,
+                           proxies={'no_proxy': NO_PROXY})
 
     if response.status_code != requests.codes.ok:
         print("MyOSG request failed (status %d): %s" % \
               (response.status_code, response.text[:2048]), file=sys.stderr)
         return None
 
-    root = ET.fromstring(response.content)
-    if root.tag != roottype + 'Summary':
-        print("MyOSG returned invalid XML with root tag %s" % root.tag,
+    target = ContactTarget(CONTACT_OWNER_PATHS[roottype])
+    parser = ET.XMLParser(target=target)
+    with response:
+        for chunk in response.iter_content(65536):
+            parser.feed(chunk)
+    results = parser.close()
+
+    if target.root_tag != roottype + 'Summary':
+        print("MyOSG returned invalid XML with root tag %s" % target.root_tag,
               file=sys.stderr)
         return None
+    if target.unexpected_tag is not None:
+        print("MyOSG returned a non-%s (%s) inside summary." % \
+              (target.owner_path[0], target.unexpected_tag), file=sys.stderr)
+        return None
 
-    return root
+    return results
 
 
 def get_vo_contacts(args):
     """
     Get resource contacts for OSG.  Return results.
     """
-    root = get_contacts(args, 'vo', 'VO')
-    if root is None:
+    results = get_contacts(args, 'vo', 'VO')
+    if results is None:
         return 1
 
-    results = {}
-    for child_vo in root:
-        if child_vo.tag != "VO":
-            print("MyOSG returned a non-VO (%s) inside summary." % \
-                  root.tag, file=sys.stderr)
-            return 1
-        name = None
-        contact_list_info = []
-        for item in child_vo:
-            if item.tag == 'Name':
-                name = item.text
-            if item.tag == "ContactTypes":
-                for contact_type in item:
-                    contact_list_info.extend( \
-                        get_contact_list_info(contact_type))
-
-        if name and contact_list_info:
-            results[name] = contact_list_info
-
-    return results
+    return results[0]
 
 
 def get_resource_contacts_by_name_and_fqdn(args):
@@ -311,42 +543,11 @@ def get_resource_contacts_by_name_and_fqdn(args):
     Returns two dictionaries, one keyed on the resource name and one keyed on
     the resource FQDN.
     """
-    root = get_contacts(args, 'rg', 'Resource')
-    if root is None:
+    results = get_contacts(args, 'rg', 'Resource')
+    if results is None:
         return {}, {}
 
-    results_by_name = {}
-    results_by_fqdn = {}
-    for child_rg in root:
-        if child_rg.tag != "ResourceGroup":
-            print("MyOSG returned a non-resource group (%s) inside summary." % \
-                  root.tag, file=sys.stderr)
-            return {}, {}
-        for child_res in child_rg:
-            if child_res.tag != "Resources":
-                continue
-            for resource in child_res:
-                resource_name = None
-                resource_fqdn = None
-                contact_list_info = []
-                for resource_tag in resource:
-                    if resource_tag.tag == 'Name':
-                        resource_name = resource_tag.text
-                    if resource_tag.tag == 'FQDN':
-                        resource_fqdn = resource_tag.text
-                    if resource_tag.tag == 'ContactLists':
-                        for contact_list in resource_tag:
-                            if contact_list.tag == 'ContactList':
-                                contact_list_info.extend( \
-                                    get_contact_list_info(contact_list))
-
-                if contact_list_info:
-                    if resource_name:
-                        results_by_name[resource_name] = contact_list_info
-                    if resource_fqdn:
-                        results_by_fqdn[resource_fqdn] = contact_list_info
-
-    return results_by_name, results_by_fqdn
+    return results
 
 
 def get_resource_contacts(args):
@@ -357,45 +558,67 @@ def get_resource_contacts_by_fqdn(args):
     return get_resource_contacts_by_name_and_fqdn(args)[1]
 
 
-def filter_contacts(args, results):
+def fetch_all(args):
     """
-    Given a set of result contacts, filter them according to given arguments
+    Get VO and resource contacts for OSG, querying for both concurrently.
+
+    Returns a tuple of the VO contacts (as from get_vo_contacts()) and the
+    resource contacts keyed on name and on FQDN (as from
+    get_resource_contacts_by_name_and_fqdn()).
     """
-    results = dict(results)  # make a copy so we don't modify the original
-
-    if getattr(args, 'name_filter', None):
-        # filter out undesired names
-        for name in list(results):
-            if not fnmatch.fnmatch(name, args.name_filter) and \
-                    args.name_filter not in name:
-                del results[name]
-    elif getattr(args, 'fqdn_filter', None):
-        # filter out undesired FQDNs
-        for fqdn in list(results):
-            if not fnmatch.fnmatch(fqdn, args.fqdn_filter) and \
-                    args.fqdn_filter not in fqdn:
-                del results[fqdn]
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Set up the session, and the VO map both queries need for --owner-vo,
+    # up front so neither is done twice by the worker threads.
+    get_auth_session(args)
+    if getattr(args, 'owner_vo', None):
+        get_vo_map(args)
 
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        vo_future = executor.submit(get_vo_contacts, args)
+        resource_future = executor.submit(get_resource_contacts_by_name_and_fqdn,
+                                          args)
+        results_by_name, results_by_fqdn = resource_future.result()
+        return vo_future.result(), results_by_name, results_by_fqdn
+
+
+def filter_contacts(args, results, copy=False):
+    """
+    Given a set of result contacts, filter them according to given arguments
+
+    `results` itself is never modified.  If no filter applies it is returned
+    as-is, unless `copy` is true, in which case a new dict is always returned.
+    """
+    # filter out undesired names (or FQDNs, depending on what `results` is keyed on)
+    name_filter = getattr(args, 'name_filter', None) or \
+                  getattr(args, 'fqdn_filter', None)
+    if name_filter:
+        name_re = re.compile(fnmatch.translate(name_filter))
+
+    # filter out undesired contact types
+    contact_types = None
     if 'all' not in args.contact_type:
-        # filter out undesired contact types
-        for name in list(results):
-            contact_list = []
-            for contact in results[name]:
-                contact_type = contact['ContactType']
-                for args_contact_type in args.contact_type:
-                    if contact_type.startswith(args_contact_type):
-                        contact_list.append(contact)
-            if contact_list == []:
-                del results[name]
-            else:
-                results[name] = contact_list
+        contact_types = tuple(args.contact_type)
 
+    email_set = None
     if getattr(args, 'contact_emails', None):
-        for name in list(results):
-            contact_list = [contact for contact in results[name] if contact['Email'] in args.contact_emails]
-            if not contact_list:
-                del results[name]
-            else:
-                results[name] = contact_list
+        email_set = frozenset(args.contact_emails)
+
+    if not name_filter and contact_types is None and email_set is None:
+        return dict(results) if copy else results
+
+    # Build a new dict in a single pass so the caller's dict is never modified
+    filtered = {}
+    for name, contacts in results.items():
+        if name_filter and not name_re.match(name) and name_filter not in name:
+            continue
+        if contact_types is not None or email_set is not None:
+            contacts = [contact for contact in contacts
+                        if (contact_types is None or
+                            contact['ContactType'].startswith(contact_types)) and
+                           (email_set is None or contact['Email'] in email_set)]
+            if not contacts:
+                continue
+        filtered[name] = contacts
 
-    return results
+    return filtered